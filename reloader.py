@@ -27,25 +27,41 @@ try:
 except ImportError:
     import __builtin__ as builtins
 
+import copy as _copy
 import imp
+import logging
 import sys
+import threading
 import types
 
 __author__ = 'Jon Parise <jon@indelible.org>'
 __version__ = '0.6.ok.patched.1'
 
-__all__ = ('enable', 'disable', 'get_dependencies', 'reload')
+__all__ = ('enable', 'disable', 'get_dependencies', 'reload',
+           'reload_dependents')
+
+_log = logging.getLogger(__name__)
 
 _baseimport = builtins.__import__
 _blacklist = None
+_blacklist_cache = dict()
 _dependencies = dict()
-_parent = None
-_parent_from_list = None
+_dependency_sets = dict()
+_dependents = dict()
+_seen_imports = set()
+_leaf_cache = dict()
+_state = threading.local()
+
+# Sentinel for attribute lookups where None is a legitimate value.
+_missing = object()
 
 # Jython doesn't have imp.reload().
 if not hasattr(imp, 'reload'):
     imp.reload = reload
 
+# Python 3 moved intern() into the sys module.
+_intern = getattr(sys, 'intern', None) or builtins.intern
+
 # PEP 328 changed the default level to 0 in Python 3.3.
 _default_level = -1 if sys.version_info < (3, 3) else 0
 
@@ -54,48 +70,106 @@ def enable(blacklist=None):
 
     A blacklist can be specified to exclude specific modules (and their import
     hierachies) from the reloading process.  The blacklist can be any iterable
-    listing the fully-qualified names of modules that should be ignored.  Note
-    that blacklisted modules will still appear in the dependency graph; they
-    will just not be reloaded.
+    listing the fully-qualified names of modules that should be ignored.
+    Note that blacklisted modules will still appear in the dependency graph;
+    they will just not be reloaded.  The dependencies of blacklisted modules
+    are not tracked, however.
     """
     global _blacklist
     builtins.__import__ = _import
     if blacklist is not None:
-        _blacklist = frozenset(blacklist)
+        # Only native strings can be interned; other entries (e.g. unicode
+        # names on Python 2) are kept as they are.
+        _blacklist = frozenset(_intern(n) if type(n) is str else n
+                               for n in blacklist)
+        _blacklist_cache.clear()
 
 def disable():
     """Disable global module dependency tracking."""
-    global _blacklist, _parent
+    global _blacklist
     builtins.__import__ = _baseimport
     _blacklist = None
+    _blacklist_cache.clear()
     _dependencies.clear()
-    _parent = None
+    _dependency_sets.clear()
+    _dependents.clear()
+    _seen_imports.clear()
+    _leaf_cache.clear()
+
+def _is_blacklisted(name):
+    """Check whether a module or any of its parent packages is blacklisted.
+
+    The name must be a module's real, fully-qualified name.  Results are
+    cached by name until the blacklist changes.
+    """
+    try:
+        return _blacklist_cache[name]
+    except KeyError:
+        pass
+    result = name in _blacklist
+    parent = name
+    while not result and '.' in parent:
+        parent = parent.rpartition('.')[0]
+        result = parent in _blacklist
+    _blacklist_cache[name] = result
+    return result
+
+def _get_parents():
+    """Get the current thread's stack of parent modules.
+
+    Each entry is a (name, fromlist) tuple for an import (or reload) that is
+    still in progress.  The innermost one is our current place in the
+    dependency graph.
+    """
+    try:
+        return _state.parents
+    except AttributeError:
+        parents = _state.parents = []
+        return parents
 
 def get_dependencies(m):
     """Get the dependency list for the given imported module."""
     name = m.__name__ if isinstance(m, types.ModuleType) else m
     return _dependencies.get(name, None)
 
-def _deepcopy_module_dict(m):
-    """Make a deep copy of a module's dictionary."""
-    import copy
+# Container types whose contents are deep-copied when a deep copy of a module's
+# dictionary is requested.  Anything else is passed through by reference.
+_deepcopy_types = (dict, list, set, tuple)
+
+def _copy_module_dict(m, deep=False):
+    """Make a copy of a module's dictionary.
 
-    # We can't deepcopy() everything in the module's dictionary because some
-    # items, such as '__builtins__', aren't deepcopy()-able.  To work around
-    # that, we start by making a shallow copy of the dictionary, giving us a
-    # way to remove keys before performing the deep copy.
+    By default this is a shallow copy.  If deep is true, the contents of
+    plain containers are deep-copied as well; other values (functions,
+    classes, modules, arbitrary objects) are still copied by reference, as
+    are containers whose contents can't be deep-copied.
+    """
+    # '__builtins__' is never interesting to a __reload__() callback, and it
+    # isn't deepcopy()-able either, so we always leave it out.
     d = vars(m).copy()
-    del d['__builtins__']
-    return copy.deepcopy(d)
+    d.pop('__builtins__', None)
+    if deep:
+        # A single memo is shared by all of the copies so that values aliased
+        # between module attributes stay aliased in the copy.  Modules can't
+        # be deep-copied, so we seed the memo to copy them by reference, and
+        # any other value that can't be copied is passed through as is.
+        memo = dict((id(mod), mod) for mod in list(sys.modules.values()))
+        for k, v in d.items():
+            if type(v) in _deepcopy_types:
+                try:
+                    d[k] = _copy.deepcopy(v, memo)
+                except Exception:
+                    pass
+    return d
 
-def _reload(m, visited, scope=None, verbose=False):
-    assert scope is None or callable(scope)
+def _reload(m, visited, scope=None, verbose=False, deep=False):
     """Internal module reloading routine."""
-    name = m.__name__
+    assert scope is None or callable(scope)
 
     # If this module's name appears in our blacklist, skip its entire
     # dependency hierarchy.
-    if _blacklist and name in _blacklist:
+    name = _intern(m.__name__)
+    if _blacklist and _is_blacklisted(name):
         return
 
     # Start by adding this module to our set of visited modules.  We use this
@@ -103,73 +177,231 @@ def _reload(m, visited, scope=None, verbose=False):
     # dependency graph.
     visited.add(m)
 
-    # Start by reloading all of our dependencies in reverse order.  Note that
-    # we recursively call ourself to perform the nested reloads.
-    deps = _dependencies.get(name, None)
-    if deps is not None:
-        for dep in reversed(deps):
+    # We reload all of our dependencies (in reverse order) before reloading
+    # the module itself.  Rather than recursing, we walk the dependency graph
+    # with an explicit stack of [module, name, dependencies, index] entries so
+    # that deep graphs can't exhaust the interpreter's call stack.  Each
+    # entry's index counts down through its dependency list, which saves us
+    # from allocating a reversed() iterator for every module.
+    deps = _dependencies.get(name, ())
+    stack = [[m, name, deps, len(deps)]]
+    while stack:
+        entry = stack[-1]
+        m, name, deps, i = entry
+
+        while i > 0:
+            i -= 1
+            dep = deps[i]
             if dep in visited:
                 if verbose: print("reload:    dependency %s visited. Skipped" % dep.__name__)
-            else:
-                if scope is not None and not scope(dep):
-                    if verbose: print("reload:    dependency %s out of scope. Skipped" % dep.__name__)
-                    continue
-                elif verbose:
-                    print("reload:    dependency %s of %s" % (dep.__name__, name))
-
-                _reload(dep, visited, scope=scope, verbose=verbose)
-
+                continue
+            if scope is not None and not scope(dep):
+                if verbose: print("reload:    dependency %s out of scope. Skipped" % dep.__name__)
+                continue
+            if verbose: print("reload:    dependency %s of %s" % (dep.__name__, name))
+
+            dep_name = _intern(dep.__name__)
+            if _blacklist and _is_blacklisted(dep_name):
+                continue
+            visited.add(dep)
+            entry[3] = i
+            dep_deps = _dependencies.get(dep_name, ())
+            stack.append([dep, dep_name, dep_deps, len(dep_deps)])
+            break
+        else:
+            # All of this module's dependencies have been handled.
+            stack.pop()
+            _reload_module(m, name, verbose, deep)
+
+def _reload_module(m, name, verbose=False, deep=False):
+    """Reload a single module whose dependencies have already been reloaded."""
     # Clear this module's list of dependencies.  Some import statements may
     # have been removed.  We'll rebuild the dependency list as part of the
-    # reload operation below.
-    try:
-        del _dependencies[name]
-    except KeyError:
-        pass
+    # reload operation below.  The reverse edges in _dependents go with them.
+    deps = _dependencies.pop(name, None)
+    _dependency_sets.pop(name, None)
+    if deps is not None:
+        for dep in deps:
+            dependents = _dependents.get(dep.__name__)
+            if dependents is not None:
+                dependents.discard(name)
+
+    # Forget which import statements have already been recorded.  Reloading
+    # this module changes its dependencies and possibly its attributes, so
+    # every import must run through the full tracking path again.
+    _seen_imports.clear()
+
+    # Drop any cached leaf modules from this module's import hierarchy.
+    prefix = name + '.'
+    for leaf_name in [n for n in _leaf_cache if n == name or n.startswith(prefix)]:
+        del _leaf_cache[leaf_name]
 
     # Because we're triggering a reload and not an import, the module itself
     # won't run through our _import hook below.  In order for this module's
     # dependencies (which will pass through the _import hook) to be associated
-    # with this module, we need to set our parent pointer beforehand.
-    global _parent
-    _parent = name
+    # with this module, we need to push it onto our parent stack beforehand.
+    parents = _get_parents()
+    parents.append((name, None))
 
     if verbose: print("reload: module %s" % name)
 
     # If the module has a __reload__(d) function, we'll call it with a copy of
     # the original module's dictionary after it's been reloaded.
-    callback = getattr(m, '__reload__', None)
-    if callback is not None:
-        d = _deepcopy_module_dict(m)
-        imp.reload(m)
-        callback(d)
-    else:
-        imp.reload(m)
-
-    # Reset our parent pointer now that the reloading operation is complete.
-    _parent = None
-
-def reload(m, scope=None, verbose=False):
+    try:
+        callback = getattr(m, '__reload__', None)
+        if callback is not None:
+            d = _copy_module_dict(m, deep)
+            imp.reload(m)
+            callback(d)
+        else:
+            imp.reload(m)
+    finally:
+        # Pop our parent entry now that the reloading operation is complete.
+        parents.pop()
+
+def reload(m, scope=None, verbose=False, deep=False):
     """Reload an existing module.
 
     Any known dependencies of the module will also be reloaded.
 
     If a module has a __reload__(d) function, it will be called with a copy of
-    the original module's dictionary after the module is reloaded."""
-    _reload(m, set(), scope=scope, verbose=verbose)
+    the original module's dictionary after the module is reloaded.  The copy
+    is shallow unless deep is true, in which case the contents of plain
+    containers (dicts, lists, sets and tuples) are deep-copied as well."""
+    _reload(m, set(), scope=scope, verbose=verbose, deep=deep)
+
+def _is_reloadable(name, m):
+    """Check whether a dependent module can safely be reloaded."""
+    if m is None or name == '__main__':
+        return False
+    if getattr(m, '__file__', None) is None:
+        return False
+    # Python 3.4+ needs a module spec to reload a module.  Modules that
+    # predate specs (Python 2) don't have the attribute at all.
+    return getattr(m, '__spec__', _missing) is not None
+
+def reload_dependents(m, scope=None, verbose=False, deep=False):
+    """Reload a module and every module that depends on it.
+
+    This is the inverse of reload(): rather than reloading the module's own
+    dependencies, it reloads the module followed by all of the modules that
+    (directly or indirectly) imported it.  A module is always reloaded after
+    the modules it depends on.  Modules that are blacklisted, that fall out of
+    scope, or that are no longer in sys.modules are skipped along with their
+    own dependents.  So are the __main__ module and modules that weren't
+    loaded from a file (or have no import spec), since reloading them would
+    re-run the main program or fail outright.
+
+    The scope, verbose and deep arguments have the same meaning as they do for
+    reload()."""
+    assert scope is None or callable(scope)
+    name = m.__name__
+    if _blacklist and _is_blacklisted(name):
+        return
+
+    # Collect the closure of the module's dependents, remembering the order in
+    # which they were discovered so that the reload order is deterministic.
+    closure = {name: m}
+    order = [name]
+    i = 0
+    while i < len(order):
+        for dep_name in _dependents.get(order[i], ()):
+            if dep_name in closure or (_blacklist and _is_blacklisted(dep_name)):
+                continue
+            dep = sys.modules.get(dep_name)
+            if not _is_reloadable(dep_name, dep) or (scope is not None and not scope(dep)):
+                if verbose: print("reload:    dependent %s out of scope. Skipped" % dep_name)
+                continue
+            closure[dep_name] = dep
+            order.append(dep_name)
+        i += 1
+    index = dict((n, i) for i, n in enumerate(order))
+
+    # Topologically sort the closure (Kahn's algorithm) so that each module is
+    # reloaded after all of its dependencies within the closure.
+    successors = dict()
+    indegree = dict.fromkeys(order, 0)
+    for n in order:
+        succ = [d for d in _dependents.get(n, ()) if d in closure and d != n]
+        succ.sort(key=index.get)
+        successors[n] = succ
+        for d in succ:
+            indegree[d] += 1
+    sorted_names = [n for n in order if indegree[n] == 0]
+    i = 0
+    while i < len(sorted_names):
+        for d in successors[sorted_names[i]]:
+            indegree[d] -= 1
+            if indegree[d] == 0:
+                sorted_names.append(d)
+        i += 1
+
+    # Modules in a dependency cycle never become ready.  We still reload them,
+    # in discovery order, after everything else.
+    if len(sorted_names) < len(order):
+        done = set(sorted_names)
+        sorted_names.extend(n for n in order if n not in done)
+
+    for n in sorted_names:
+        if verbose and n != name: print("reload:    dependent %s of %s" % (n, name))
+        _reload_module(closure[n], n, verbose, deep)
 
 def _import(name, globals=None, locals=None, fromlist=None, level=_default_level):
     """__import__() replacement function that tracks module dependencies."""
     # Track our current parent module.  This is used to find our current place
     # in the dependency graph.
-    global _parent, _parent_from_list
-    parent = _parent
-    parent_from_list = _parent_from_list
-    _parent = name
-    _parent_from_list = fromlist
+    #
+    # The parent stack lookup is inlined rather than going through
+    # _get_parents() because this hook runs on every import statement.
+    try:
+        parents = _state.parents
+    except AttributeError:
+        parents = _get_parents()
+    if parents:
+        parent, parent_from_list = parents[-1]
+    else:
+        parent = parent_from_list = None
+
+    # The compiler always passes fromlist as a tuple, but __import__() can be
+    # called directly with any sequence.  We normalize it once here so that it
+    # can be used in hashable keys (including our children's, via the stack).
+    if fromlist is not None and type(fromlist) is not tuple:
+        fromlist = tuple(fromlist)
+    parents.append((name, fromlist))
 
-    # Perform the actual import work using the base import function.
-    base = _baseimport(name, globals, locals, fromlist, level)
+    # Perform the actual import work using the base import function.  We
+    # always restore our parent stack afterward, even if the import fails.
+    try:
+        base = _baseimport(name, globals, locals, fromlist, level)
+    finally:
+        parents.pop()
+
+    # Imports made by blacklisted modules are never needed for reloading, so
+    # we don't spend any time tracking them.  The blacklisted module itself
+    # is still recorded as a dependency of whatever imported it.  As when
+    # recording dependencies below, the importing module is the one whose
+    # globals we were called with; the parent stack is only a fallback.
+    # Parent stack entries can be relative names, so we only match those
+    # exactly rather than treating (and caching) them as module hierarchies.
+    if _blacklist:
+        if globals is not None:
+            caller_mod_name = globals.get('__name__')
+            if caller_mod_name is not None and _is_blacklisted(caller_mod_name):
+                return base
+        elif parent in _blacklist:
+            return base
+
+    # Repeated import statements (e.g. inside functions) resolve to the same
+    # dependencies every time, so once an import has been fully tracked we can
+    # skip straight to returning its result.
+    seen_key = (parent,
+                parent_from_list,
+                globals.get('__name__') if globals is not None else None,
+                name,
+                fromlist,
+                level)
+    if seen_key in _seen_imports:
+        return base
 
     if base is not None:
         m = base
@@ -181,12 +413,25 @@ def _import(name, globals=None, locals=None, fromlist=None, level=_default_level
         # no fromlist has been specified.  It's possible that the package
         # might not have all of its descendents as attributes, in which case
         # we fall back to using the immediate ancestor of the module instead.
+        #
+        # The leaf of an absolute dotted import doesn't change once it has
+        # been imported, so we cache it by name.  Cached entries are only
+        # trusted while they still match sys.modules.  (Modules aren't
+        # weakref-able on Python 2, so the cache holds them directly and
+        # relies on _reload() and disable() to evict stale entries.)
         if fromlist is None:
-            for component in name.split('.')[1:]:
-                try:
-                    m = getattr(m, component)
-                except AttributeError:
-                    m = sys.modules[m.__name__ + '.' + component]
+            if '.' in name:
+                leaf = _leaf_cache.get(name) if level == 0 else None
+                if leaf is not None and leaf is sys.modules.get(name):
+                    m = leaf
+                else:
+                    for component in name.split('.')[1:]:
+                        try:
+                            m = getattr(m, component)
+                        except AttributeError:
+                            m = sys.modules[m.__name__ + '.' + component]
+                    if level == 0 and isinstance(m, types.ModuleType):
+                        _leaf_cache[name] = m
         elif fromlist != ('*',):
             # FIX (ok.20150702): check if fromlist contains modules, i.e. dependencies
             # Here are two options:
@@ -194,51 +439,71 @@ def _import(name, globals=None, locals=None, fromlist=None, level=_default_level
             # 2) m is module and fromlist consist of module's attributes which can have references to modules
             # Actually, attributes can be objects from another module imported into m, i.e. dependency as well,
             # but they will be resolved as dependency of m. I.e. here checked 1.a case only.
+            modules = sys.modules
+            module_type = types.ModuleType
+            m_name = m.__name__
+            m_prefix = m_name + '.'
+            m_deps = _dependency_sets.get(m_name, ())
+
+            # A plain module's attributes all live in its __dict__, so we can
+            # look them up there directly.  Module subclasses may define
+            # descriptors, and modules with a __getattr__() function (PEP 562)
+            # compute some of their attributes, so both go through getattr().
+            m_dict = vars(m) if type(m) is module_type else None
+            if m_dict is not None and '__getattr__' in m_dict:
+                m_dict = None
+
             for fromname in fromlist:
                 try:
-                    if not hasattr(m, fromname):
+                    if m_dict is not None:
+                        submodule = m_dict.get(fromname, _missing)
+                    else:
+                        submodule = getattr(m, fromname, _missing)
+                    if submodule is _missing:
                         # fromname is not module attribute and _baseimport has not failed importing them.
                         # Most brobably they are submodules of package
-                        submodule = sys.modules.get(m.__name__ + '.' + fromname)
-                    else:
-                        submodule = getattr(m, fromname)
-                    if isinstance(submodule, types.ModuleType) and submodule not in _dependencies.get(m.__name__, []):
+                        submodule = modules.get(m_prefix + fromname)
+                    if isinstance(submodule, module_type) and submodule not in m_deps:
                         m_sub.append(submodule)
                 except Exception as e:
-                    print('Something happened during submodule check', e)
+                    if _log.isEnabledFor(logging.DEBUG):
+                        _log.debug('submodule check of %s.%s failed: %r', m_name, fromname, e)
                     raise
 
         # If this is a nested import for a reloadable (source-based) module,
-        # we append ourself to our parent's dependency list.
+        # we append ourself to the importing module's dependency list.
+        #
+        # The importing module is the one whose globals we were called with.
+        # The parent stack is only a fallback: its entries are the raw names
+        # passed to __import__(), which aren't real module names for relative
+        # imports (e.g. 'util' for `from .util import x`), and which name the
+        # package rather than the submodule for `from package import module`.
         if hasattr(m, '__file__'):
-            if parent is not None:
-                actual_parent = parent
-                if globals is not None and len(parent) > 0 and parent_from_list:
-                    # FIX (ok.20150702): Check if actual parent is one of parent_from_list instead of parent
-                    caller_mod_name = globals.get('__name__', None)
-                    if caller_mod_name is not None and caller_mod_name in sys.modules:
-                        if caller_mod_name.startswith(parent + '.'):
-                            tail = caller_mod_name[len(parent + '.'):]
-                            if tail in parent_from_list:
-                                actual_parent = caller_mod_name
-
-                _add_dependency(actual_parent, m, m_sub)
-
-            elif globals is not None:
-                # FIX (ok.20150702): for run-time imports
-                caller_mod_name = globals.get('__name__', None)
-                rt_parent = caller_mod_name and sys.modules.get(caller_mod_name)
-                if rt_parent is not None:
-                    _add_dependency(rt_parent, m, m_sub)
-
-    # Lastly, we always restore our global _parent pointer.
-    _parent = parent
-    _parent_from_list = parent_from_list
+            caller_mod_name = globals.get('__name__') if globals is not None else None
+            if caller_mod_name is not None and caller_mod_name in sys.modules:
+                _add_dependency(caller_mod_name, m, m_sub)
+            elif parent is not None:
+                _add_dependency(parent, m, m_sub)
+
+    _seen_imports.add(seen_key)
 
     return base
 
-def _add_dependency(parent, mod, mod_subs=None):
-    l = _dependencies.setdefault(parent.__name__ if isinstance(parent, types.ModuleType) else parent, [])
+def _add_dependency(name, mod, mod_subs=None):
+    # Dependencies are keyed by the importing module's name rather than the
+    # module object, since get_dependencies() and _reload() look up by name.
+    # Callers always pass that name, so no type check is needed here.
+    #
+    # Each dependency list is paired with a set of the same modules so that
+    # membership tests stay O(1) while the list preserves import order.
+    #
+    # The name is interned so that later lookups by the same name (from
+    # _reload() or from subsequent imports) can compare keys by identity.
+    name = _intern(name)
+    l = _dependencies.setdefault(name, [])
+    s = _dependency_sets.setdefault(name, set())
     for m in [mod] + (mod_subs or []):
-        if m not in l:
+        if m not in s:
+            s.add(m)
             l.append(m)
+            _dependents.setdefault(m.__name__, set()).add(name)
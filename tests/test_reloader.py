@@ -6,6 +6,7 @@ class ReloaderTests(unittest.TestCase):
 
     def setUp(self):
         self.modules = {}
+        self.dirs = []
 
         # Save the existing system bytecode setting so that it can
         # be restored later.  We need to disable bytecode writing
@@ -20,6 +21,8 @@ class ReloaderTests(unittest.TestCase):
                 del sys.modules[name]
             if os.path.exists(filename):
                 os.unlink(filename)
+        for dirname in reversed(self.dirs):
+            os.rmdir(dirname)
 
         # Restore the system bytecode setting.
         sys.dont_write_bytecode = self._dont_write_bytecode
@@ -47,6 +50,77 @@ class ReloaderTests(unittest.TestCase):
 
         reloader.disable()
 
+    def test_import_error(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testbroken', "import tests.testdep\nraise ImportError\n")
+        self.write_module('testdep', "def func(): return True\n")
+        self.write_module('testmodule', "import tests.testdep\n")
+
+        self.assertRaises(ImportError, __import__, 'tests.testbroken')
+        import tests.testmodule
+
+        # A failed import must not leave itself behind as the parent of
+        # subsequent imports.
+        self.assertFalse(tests.testmodule in
+                         reloader.get_dependencies('tests.testbroken'))
+
+        reloader.disable()
+
+    def test_reload_callback(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testmodule', "STATE = [1]\n")
+        import tests.testmodule
+        tests.testmodule.STATE.append(2)
+
+        self.write_module('testmodule', "STATE = []\n"
+                                        "def __reload__(d):\n"
+                                        "    global STATE\n"
+                                        "    STATE = d['STATE']\n")
+        reloader.reload(tests.testmodule)
+        # The first reload runs the old module code, which has no callback.
+        self.assertEqual([], tests.testmodule.STATE)
+
+        tests.testmodule.STATE.append(3)
+        old_state = tests.testmodule.STATE
+        reloader.reload(tests.testmodule)
+        self.assertTrue(tests.testmodule.STATE is old_state)
+
+        reloader.reload(tests.testmodule, deep=True)
+        self.assertEqual([3], tests.testmodule.STATE)
+        self.assertFalse(tests.testmodule.STATE is old_state)
+
+        reloader.disable()
+
+    def test_reload_callback_deep(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testmodule', "import os\n"
+                                        "A = [1]\n"
+                                        "B = {'a': A}\n"
+                                        "REGISTRY = {'os': os}\n"
+                                        "def __reload__(d):\n"
+                                        "    global PREVIOUS\n"
+                                        "    PREVIOUS = d\n")
+        import tests.testmodule
+        old_a = tests.testmodule.A
+        reloader.reload(tests.testmodule, deep=True)
+        d = tests.testmodule.PREVIOUS
+
+        # Aliased values stay aliased in the copy.
+        self.assertEqual([1], d['A'])
+        self.assertFalse(d['A'] is old_a)
+        self.assertTrue(d['A'] is d['B']['a'])
+
+        # Modules can't be deep-copied, so they're passed through by reference.
+        self.assertTrue(d['REGISTRY']['os'] is os)
+
+        reloader.disable()
+
     def test_blacklist(self):
         import reloader
         reloader.enable(['blacklisted'])
@@ -58,9 +132,230 @@ class ReloaderTests(unittest.TestCase):
 
         reloader.disable()
 
+    def test_reload_hierarchy(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testleaf', "VALUE = 1\n")
+        self.write_module('testdep', "import tests.testleaf\n")
+        self.write_module('testmodule', "import tests.testdep\n"
+                                        "from tests.testleaf import VALUE\n")
+        import tests.testmodule
+        self.assertEqual(1, tests.testmodule.VALUE)
+
+        self.write_module('testleaf', "VALUE = 2\n")
+        reloader.reload(tests.testmodule)
+        self.assertEqual(2, tests.testmodule.VALUE)
+
+        reloader.disable()
+
+    def test_reload_dependents(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testleaf', "VALUE = 1\n")
+        self.write_module('testdep', "from tests.testleaf import VALUE\n")
+        self.write_module('testmodule', "import tests.testdep\n"
+                                        "import tests.testleaf\n"
+                                        "VALUE = tests.testdep.VALUE\n")
+        import tests.testmodule
+        self.assertEqual(1, tests.testmodule.VALUE)
+
+        # testmodule depends on testleaf directly and through testdep, so it
+        # has to be reloaded after both of them.  This test module imported
+        # testmodule at run-time, which makes it a dependent too; we keep it
+        # out of scope so that it doesn't re-execute itself.
+        self.write_module('testleaf', "VALUE = 2\n")
+        reloaded = self.reload_dependents(sys.modules['tests.testleaf'])
+        self.assertEqual(['tests.testleaf', 'tests.testdep', 'tests.testmodule'],
+                         reloaded)
+        self.assertEqual(2, sys.modules['tests.testdep'].VALUE)
+        self.assertEqual(2, tests.testmodule.VALUE)
+
+        reloader.disable()
+
+    def test_reload_dependents_relative(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testleaf', "VALUE = 1\n")
+        self.write_module('testdep', "import tests.testleaf\n"
+                                     "VALUE = tests.testleaf.VALUE\n")
+        self.write_module('testmodule', "from .testdep import VALUE\n")
+        import tests.testmodule
+
+        # testdep was imported under the relative name 'testdep', but its
+        # dependencies belong to the real tests.testdep module.
+        self.assertEqual([sys.modules['tests.testleaf']],
+                         reloader.get_dependencies('tests.testdep'))
+        self.assertEqual(None, reloader.get_dependencies('testdep'))
+
+        self.write_module('testleaf', "VALUE = 2\n")
+        reloaded = self.reload_dependents(sys.modules['tests.testleaf'])
+        self.assertEqual(['tests.testleaf', 'tests.testdep', 'tests.testmodule'],
+                         reloaded)
+        self.assertEqual(2, tests.testmodule.VALUE)
+
+        reloader.disable()
+
+    def test_reload_dependents_cycle(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testleaf', "VALUE = 1\n")
+        self.write_module('testdep', "import tests.testleaf\n"
+                                     "import tests.testmodule\n")
+        self.write_module('testmodule', "import tests.testdep\n")
+        import tests.testdep
+
+        # testdep and testmodule import each other, so neither of them is
+        # ever ready; they're reloaded after testleaf in discovery order.
+        reloaded = self.reload_dependents(sys.modules['tests.testleaf'])
+        self.assertEqual(['tests.testleaf', 'tests.testdep', 'tests.testmodule'],
+                         reloaded)
+
+        reloader.disable()
+
+    def test_reload_dependents_main(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testleaf', "VALUE = 1\n")
+        exec("import tests.testleaf", {'__name__': '__main__'})
+
+        # The import above was made by __main__, which must never be reloaded.
+        self.assertTrue('__main__' in reloader._dependents['tests.testleaf'])
+        reloaded = self.reload_dependents(sys.modules['tests.testleaf'])
+        self.assertEqual(['tests.testleaf'], reloaded)
+
+        reloader.disable()
+
+    def test_dependencies(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testdep', "def func(): return True\n")
+        self.write_module('testmodule', "import tests.testdep\nimport tests.testdep\n")
+
+        import tests.testmodule
+        deps = reloader.get_dependencies(tests.testmodule)
+        self.assertEqual([sys.modules['tests.testdep']], deps)
+
+        reloader.disable()
+
+    def test_reload_dependencies(self):
+        import reloader
+        reloader.enable()
+
+        self.write_module('testdep', "def func(): return True\n")
+        self.write_module('testmodule', "import tests.testdep\n")
+
+        import tests.testmodule
+        self.assertEqual([sys.modules['tests.testdep']],
+                         reloader.get_dependencies(tests.testmodule))
+
+        self.write_module('testmodule', "")
+        reloader.reload(tests.testmodule)
+        self.assertEqual(None, reloader.get_dependencies(tests.testmodule))
+
+        self.write_module('testmodule', "import tests.testdep\n")
+        reloader.reload(tests.testmodule)
+        self.assertEqual([sys.modules['tests.testdep']],
+                         reloader.get_dependencies(tests.testmodule))
+
+        reloader.disable()
+
+    def test_blacklist_dependencies(self):
+        import reloader
+        reloader.enable(['tests.testdep', 'tests.testpkg'])
+
+        self.write_module('testleaf', "VALUE = 1\n")
+        self.write_module('testdep', "import tests.testleaf\n")
+        self.write_module('testpkg.__init__', "from .sub import VALUE\n")
+        self.write_module('testpkg.sub', "import tests.testleaf\n"
+                                         "VALUE = tests.testleaf.VALUE\n")
+        self.write_module('testmodule', "from tests import testdep\n"
+                                        "import tests.testpkg\n")
+        import tests.testmodule
+
+        self.assertEqual([sys.modules['tests'],
+                          sys.modules['tests.testdep'],
+                          sys.modules['tests.testpkg']],
+                         reloader.get_dependencies(tests.testmodule))
+
+        # Imports made by blacklisted modules aren't tracked, whether they
+        # were imported through a package's fromlist or by a relative name.
+        self.assertEqual(None, reloader.get_dependencies('tests.testdep'))
+        self.assertEqual(None, reloader.get_dependencies('tests.testpkg.sub'))
+        self.assertEqual(None, reloader.get_dependencies('tests'))
+        self.assertEqual(None, reloader.get_dependencies('sub'))
+
+        # Hierarchy matches are only made (and cached) for real module names,
+        # never for the raw names of relative imports.
+        for name in reloader._blacklist_cache:
+            self.assertTrue(name in sys.modules, name)
+
+        reloader.disable()
+
+    def test_blacklist_names(self):
+        import reloader
+
+        # Only exact str instances can be interned, but the blacklist has
+        # always accepted other string types too (e.g. unicode on Python 2).
+        class Name(str):
+            pass
+        reloader.enable([Name('tests.testmodule')])
+
+        self.write_module('testmodule', "def func(): return 'Some code.'\n")
+        import tests.testmodule
+
+        self.write_module('testmodule', "def func(): return 'New code.'\n")
+        reloader.reload(tests.testmodule)
+        self.assertEqual('Some code.', tests.testmodule.func())
+
+        reloader.disable()
+
+    def test_blacklist_hierarchy(self):
+        import reloader
+        reloader.enable(['tests'])
+
+        self.write_module('testmodule', "def func(): return 'Some code.'\n")
+        import tests.testmodule
+
+        self.write_module('testmodule', "def func(): return 'New code.'\n")
+        reloader.reload(tests.testmodule)
+        self.assertEqual('Some code.', tests.testmodule.func())
+
+        reloader.disable()
+
+    def reload_dependents(self, m):
+        """Run reloader.reload_dependents() and return the reloaded names."""
+        import reloader
+        reloaded = []
+        reload_module = reloader._reload_module
+        def spy(m, name, *args, **kwargs):
+            reloaded.append(name)
+            return reload_module(m, name, *args, **kwargs)
+        reloader._reload_module = spy
+        try:
+            reloader.reload_dependents(m, scope=lambda m: m.__name__ != __name__)
+        finally:
+            reloader._reload_module = reload_module
+        return reloaded
+
     def write_module(self, name, contents):
-        filename = os.path.join(os.path.dirname(__file__), name + '.py')
-        self.modules['tests.' + name] = filename
+        # Dotted names are written into (sub)packages of the tests package,
+        # with 'package.__init__' naming the package itself.
+        path = name.split('.')
+        filename = os.path.join(os.path.dirname(__file__), *path) + '.py'
+        if path[-1] == '__init__':
+            path.pop()
+        self.modules['.'.join(['tests'] + path)] = filename
+
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+            self.dirs.append(dirname)
 
         f = open(filename, 'w')
         f.write(contents)